@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+from operator import attrgetter
 
 from adaptive_profiler import AdaptiveProfiler
 
@@ -16,20 +17,30 @@ parser.add_argument(
     default='time',
     help='which resource to measure')
 
+parser.add_argument(
+    '--mode', choices=['tracing', 'sampling'],
+    default='tracing',
+    help='whether to trace every call or to periodically sample the stack')
+
 parser.add_argument(
     '--runs', type=int, metavar='N',
     default=4,
     help='how many runs to make')
 
+parser.add_argument(
+    '--output', type=str, metavar='PATH',
+    help='file to stream the statistics of every call to, in tracing mode')
+
 args = parser.parse_args()
 
-profiler = AdaptiveProfiler(resource=args.resource)
+profiler = AdaptiveProfiler(
+    resource=args.resource, mode=args.mode, output_path=args.output)
 for i in range(args.runs):
     with profiler:
         module = __import__(args.path)
     profiler.update()
 
-stats = profiler.get_statistics()
-stats.sort(key=lambda s: s.total, reverse=True)
+# Avoids importing any dependencies which could affect the profiled program
+stats = sorted(profiler.get_statistics(), key=attrgetter('total'), reverse=True)
 for fn_stats in stats:
     print(fn_stats)
@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+
+import argparse
+
+from util.records import read_records
+
+parser = argparse.ArgumentParser(
+    description='Aggregate the statistics streamed to a file by adaprof.')
+
+parser.add_argument(
+    'path', type=str,
+    help='path to the file written by the profiler')
+
+args = parser.parse_args()
+
+stats = read_records(args.path)
+for fn_stats in stats.sorted_by_total():
+    print(fn_stats)
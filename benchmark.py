@@ -6,11 +6,25 @@ from time import perf_counter
 from adaptive_profiler import AdaptiveProfiler
 
 from benchmark import Benchmark
-from benchmark.matmul import MatMulBenchmark
+from benchmark.matmul import (MatMulBenchmark, NumbaMatMulBenchmark,
+                              NumPyMatMulBenchmark, numba_available)
 from benchmark.ml import MachineLearningBenchmark
 
+from util.gc import gc_disabled
 from util.timer import Timer
-from util.cprofile import capture_stats_output, parse
+from util.cprofile import parse
+from util.stats import StatsTable
+
+
+# Profilers are reused across benchmarks, being reset before each one
+adaprof = AdaptiveProfiler()
+sampler = AdaptiveProfiler(mode='sampling')
+
+
+def print_time_per_call(stats: StatsTable):
+    time_per_call = stats.cumulative_ns / stats.num_calls
+    for name, time in zip(stats.names, time_per_call):
+        print(f'{name}:', time)
 
 
 def run_benchmark(benchmark: Benchmark):
@@ -18,8 +32,10 @@ def run_benchmark(benchmark: Benchmark):
 
     no_profiling_timer = Timer('No profiling')
     with no_profiling_timer:
-        while not benchmark.done:
-            benchmark.run_iteration()
+        # The adaptive profiler also disables the garbage collector
+        with gc_disabled():
+            while not benchmark.done:
+                benchmark.run_iteration()
 
     benchmark.verify_result()
 
@@ -28,7 +44,7 @@ def run_benchmark(benchmark: Benchmark):
     cprofile_timer = Timer('cProfile')
     profile = cProfile.Profile(timer=perf_counter)
     with cprofile_timer:
-        with profile:
+        with gc_disabled(), profile:
             while not benchmark.done:
                 benchmark.run_iteration()
 
@@ -37,7 +53,7 @@ def run_benchmark(benchmark: Benchmark):
     benchmark.reset()
 
     adaprof_timer = Timer('Adaptive profiler')
-    adaprof = AdaptiveProfiler()
+    adaprof.reset()
     with adaprof_timer:
         with adaprof:
             while not benchmark.done:
@@ -46,17 +62,30 @@ def run_benchmark(benchmark: Benchmark):
 
     benchmark.verify_result()
 
+    benchmark.reset()
+
+    sampling_timer = Timer('Sampling profiler')
+    sampler.reset()
+    with sampling_timer:
+        with sampler:
+            while not benchmark.done:
+                benchmark.run_iteration()
+                sampler.update()
+
+    benchmark.verify_result()
+
     print(f'No profiling duration: {no_profiling_timer.total_time} ns')
     print(f'cProfile duration: {cprofile_timer.total_time} ns')
     print(f'Adaptive profiler duration: {adaprof_timer.total_time} ns')
+    print(f'Sampling profiler duration: {sampling_timer.total_time} ns')
+    print(f'Sampling profiler final interval: {sampler.sampling_interval} ns')
 
     print_function_stats = False
 
     if print_function_stats:
-        output = capture_stats_output(profile)
-        cprofile_stats = parse(output)
+        cprofile_stats = parse(profile)
 
-        adaprof_stats = adaprof.get_statistics()
+        adaprof_stats = StatsTable.from_rows(adaprof.get_statistics())
 
         print('cProfile stats')
         for stat in cprofile_stats:
@@ -69,23 +98,24 @@ def run_benchmark(benchmark: Benchmark):
         print('Time percentages')
 
         print("cProfile:")
-        cprofile_stats.sort(key=lambda s: s.total, reverse=True)
-        for stat in cprofile_stats:
-            print(f'{stat.name}:', stat.cumulative / stat.num_calls)
+        print_time_per_call(cprofile_stats.sorted_by_total())
 
         print("Adaptive profiler:")
-        adaprof_stats.sort(key=lambda s: s.total, reverse=True)
-        for stat in adaprof_stats:
-            print(f'{stat.name}:', stat.cumulative / stat.num_calls)
+        print_time_per_call(adaprof_stats.sorted_by_total())
 
         print()
 
     cprofile_overhead = cprofile_timer.total_time / no_profiling_timer.total_time
     base_overhead = adaprof_timer.total_time / no_profiling_timer.total_time
     relative_overhead = adaprof_timer.total_time / cprofile_timer.total_time
+    sampling_overhead = sampling_timer.total_time / no_profiling_timer.total_time
     print(f"cProfile vs no profiler: {cprofile_overhead}")
     print(f"Adaptive profiler vs no profiler: {base_overhead}")
     print(f"Adaptive profiler vs cProfile: {relative_overhead}")
+    print(f"Sampling profiler vs no profiler: {sampling_overhead}")
 
 
 run_benchmark(MatMulBenchmark())
+run_benchmark(NumPyMatMulBenchmark())
+if numba_available:
+    run_benchmark(NumbaMatMulBenchmark())
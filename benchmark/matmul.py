@@ -1,16 +1,23 @@
-import random
 import numpy as np
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+from util.timer import elapsed_ns
+
 from . import Benchmark
 
+numba_available = numba is not None
+
 
 def random_matrices(n, m, p):
-    """Generates two matrices which can be multiplied together,
+    """Generates two arrays which can be multiplied together,
     containing random real numbers.
     """
-    A = [[random.random() for _ in range(m)] for _ in range(n)]
-    B = [[random.random() for _ in range(p)] for _ in range(m)]
-    return A, B
+    rng = np.random.default_rng()
+    return rng.random((n, m)), rng.random((m, p))
 
 
 def multiply(a, b):
@@ -18,23 +25,83 @@ def multiply(a, b):
     return a * b
 
 
-def multiply_matrices(A, B):
-    "Multiplies two matrices"
+def multiply_matrices_into(A, B, C):
+    "Multiplies two arrays using NumPy, storing the result in `C`"
+    np.matmul(A, B, out=C)
+
+
+def multiply_matrices_py(A, B):
+    "Multiplies two matrices using pure Python loops"
+    C = [[0 for _ in range(len(B[0]))] for _ in range(len(A))]
+    multiply_matrices_py_into(A, B, C)
+    return C
+
+
+def multiply_matrices_py_into(A, B, C):
+    "Multiplies two matrices using pure Python loops, storing the result in `C`"
     assert len(A[0]) == len(B)
     n = len(A)
-    m = len(B)
     p = len(B[0])
 
-    C = [[0 for _ in range(p)] for _ in range(n)]
+    # Bind to locals to avoid repeated global lookups and indexing in the loops.
+    # `multiply` is still called, since it's the function profilers should measure.
+    mul = multiply
+
+    # Transpose `B` so that each element of the result is the dot product of two rows
+    BT = [list(column) for column in zip(*B)]
 
     for i in range(n):
+        Ai = A[i]
+        Ci = C[i]
         for j in range(p):
-            acc = 0
-            for k in range(m):
-                acc += multiply(A[i][k], B[k][j])
-            C[i][j] = acc
+            Ci[j] = sum(map(mul, Ai, BT[j]))
 
-    return C
+
+def specialize_multiply_matrices_py_into(n, m, p):
+    """Generates a version of `multiply_matrices_py_into` for fixed matrix sizes,
+    with constant loop bounds and an unrolled dot product.
+
+    The generated function expects `B` to already be transposed, and is named
+    after its sizes, so that profilers don't confuse it with other versions.
+    """
+    name = f'multiply_matrices_py_into_{n}x{m}x{p}'
+    products = ' + '.join(f'mul(Ai[{k}], BTj[{k}])' for k in range(m)) or '0'
+    source = (
+        f'def {name}(A, BT, C, mul=multiply):\n'
+        f'    for i in range({n}):\n'
+        f'        Ai = A[i]\n'
+        f'        Ci = C[i]\n'
+        f'        for j in range({p}):\n'
+        f'            BTj = BT[j]\n'
+        f'            Ci[j] = {products}\n'
+    )
+
+    namespace = {'multiply': multiply}
+    code = compile(source, f'<{name}>', 'exec')
+    exec(code, namespace)
+    return namespace[name]
+
+
+if numba_available:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def multiply_matrices_kernel(A, B, C):
+        "Multiplies two 2D arrays, storing the result in `C`"
+        n, m = A.shape
+        p = B.shape[1]
+        for i in numba.prange(n):
+            for j in range(p):
+                acc = 0.0
+                for k in range(m):
+                    acc += A[i, k] * B[k, j]
+                C[i, j] = acc
+
+    def multiply_matrices_numba_into(A, B, C):
+        "Multiplies two arrays using a loop compiled by Numba, storing the result in `C`"
+        assert A.shape[1] == B.shape[0]
+        multiply_matrices_kernel(A, B, C)
+else:
+    def multiply_matrices_numba_into(A, B, C):
+        raise ImportError('Multiplying matrices with Numba requires the numba package')
 
 
 def verify_result(A, B, C):
@@ -43,18 +110,31 @@ def verify_result(A, B, C):
 
 
 class MatMulBenchmark(Benchmark):
+    """Multiplies matrices using pure Python loops,
+    which makes lots of short function calls for the profilers to measure.
+    """
+
     def __init__(self):
         A, B = random_matrices(50, 30, 40)
-        self.A = A
-        self.B = B
+        self.setup(A, B)
         self.counter = 0
 
+    def setup(self, A, B):
+        "Stores the inputs and allocates the result, as used by `run_iteration`"
+        (n, m), p = A.shape, B.shape[1]
+        self.A = A.tolist()
+        self.B = B.tolist()
+        self.BT = B.T.tolist()
+        # The result is overwritten by every iteration
+        self.C = [[0.0] * p for _ in range(n)]
+        self.multiply_into = specialize_multiply_matrices_py_into(n, m, p)
+
     @property
     def name(self):
         return 'Matrix multiplication'
 
     def run_iteration(self):
-        self.C = multiply_matrices(self.A, self.B)
+        self.multiply_into(self.A, self.BT, self.C)
         self.counter += 1
 
     def verify_result(self):
@@ -68,8 +148,45 @@ class MatMulBenchmark(Benchmark):
         self.counter = 0
 
 
+class NumPyMatMulBenchmark(MatMulBenchmark):
+    "Multiplies the same matrices with a single call into NumPy"
+
+    def setup(self, A, B):
+        self.A = A
+        self.B = B
+        self.C = np.empty((A.shape[0], B.shape[1]))
+
+    @property
+    def name(self):
+        return 'Matrix multiplication (NumPy)'
+
+    def run_iteration(self):
+        multiply_matrices_into(self.A, self.B, self.C)
+        self.counter += 1
+
+
+class NumbaMatMulBenchmark(NumPyMatMulBenchmark):
+    "Multiplies the same matrices with a loop compiled by Numba"
+
+    def __init__(self):
+        super().__init__()
+        # Compile the kernel before it gets measured
+        multiply_matrices_numba_into(self.A, self.B, self.C)
+
+    @property
+    def name(self):
+        return 'Matrix multiplication (Numba)'
+
+    def run_iteration(self):
+        multiply_matrices_numba_into(self.A, self.B, self.C)
+        self.counter += 1
+
+
 if __name__ == '__main__':
     A, B = random_matrices(50, 30, 40)
+    A, B = A.tolist(), B.tolist()
     N = 512
+    total_time = 0
     for _ in range(N):
-        C = multiply_matrices(A, B)
+        total_time += elapsed_ns(multiply_matrices_py, A, B)
+    print(f'Average duration: {total_time // N} ns')
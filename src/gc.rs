@@ -0,0 +1,23 @@
+//! Control over Python's garbage collector while profiling.
+
+use pyo3::prelude::*;
+
+/// Runs a full collection, then disables the garbage collector.
+///
+/// Returns whether the collector was previously enabled.
+pub fn pause(py: Python) -> PyResult<bool> {
+    let gc = py.import("gc")?;
+
+    let was_enabled = gc.getattr("isenabled")?.call0()?.extract()?;
+    gc.getattr("collect")?.call0()?;
+    gc.getattr("disable")?.call0()?;
+
+    Ok(was_enabled)
+}
+
+/// Enables the garbage collector again.
+pub fn resume(py: Python) -> PyResult<()> {
+    py.import("gc")?.getattr("enable")?.call0()?;
+
+    Ok(())
+}
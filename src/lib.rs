@@ -1,9 +1,13 @@
-use std::{cell::RefCell, ffi::CStr, mem, ptr};
+use std::{cell::RefCell, mem, ptr};
 
-use pyo3::{ffi, prelude::*, types::PyString, FromPyPointer, PyContextProtocol, PyObjectProtocol};
+use pyo3::{exceptions::PyValueError, ffi, prelude::*, PyContextProtocol, PyObjectProtocol};
 
 mod lifecycle;
 
+mod gc;
+
+mod monitoring;
+
 mod counter;
 
 mod stopwatch;
@@ -18,6 +22,14 @@ mod update;
 mod profiler;
 use crate::profiler::{AbstractProfiler, Profiler};
 
+mod output;
+use crate::output::StatsWriter;
+
+mod symbols;
+
+mod sampling;
+use crate::sampling::Sampler;
+
 thread_local! {
     static PROFILER: RefCell<Option<Box<dyn AbstractProfiler>>> = RefCell::new(None);
 }
@@ -33,6 +45,17 @@ where
     })
 }
 
+/// Like `with_profiler`, but returns `None` on threads without a profiler.
+fn try_with_profiler<F, R>(f: F) -> Option<R>
+where
+    F: FnOnce(&mut dyn AbstractProfiler) -> R,
+{
+    PROFILER.with(|profiler| {
+        let mut profiler = profiler.borrow_mut();
+        profiler.as_mut().map(|profiler| f(profiler.as_mut()))
+    })
+}
+
 #[pyclass]
 pub struct FunctionStatistics {
     #[pyo3(get, set)]
@@ -55,70 +78,231 @@ impl PyObjectProtocol for FunctionStatistics {
     }
 }
 
+/// Creates a tracing profiler measuring the given resource.
+fn create_profiler(resource: &str) -> Box<dyn AbstractProfiler> {
+    match resource {
+        "time" => {
+            let counter = crate::time::TimeCounter;
+            let profiler = Profiler::new(counter);
+            Box::new(profiler)
+        }
+        "cache_misses" => {
+            let counter = crate::perfcnt::HardwarePerformanceCounter::cache_misses();
+            let profiler = Profiler::new(counter);
+            Box::new(profiler)
+        }
+        "branch_misses" => {
+            let counter = crate::perfcnt::HardwarePerformanceCounter::branch_misses();
+            let profiler = Profiler::new(counter);
+            Box::new(profiler)
+        }
+        resource => panic!("Unknown resource type: '{}'", resource),
+    }
+}
+
 /// An adaptive Python profiler, implemented in Rust.
 #[pyclass(unsendable)]
-pub struct AdaptiveProfiler {}
+pub struct AdaptiveProfiler {
+    /// Whether events are received through `sys.monitoring` instead of `PyEval_SetProfile`.
+    use_monitoring: bool,
+    /// Stack sampler used instead of tracing, if running in sampling mode.
+    sampler: Option<Sampler>,
+    /// Whether the garbage collector was enabled before the profiler was.
+    gc_was_enabled: bool,
+}
+
+impl AdaptiveProfiler {
+    /// Starts the sampler or installs the profiling hook.
+    fn start(&mut self, py: Python) -> PyResult<()> {
+        if let Some(sampler) = self.sampler.as_mut() {
+            return sampler.start(py);
+        }
+
+        with_profiler(|profiler| profiler.enable());
+
+        if self.use_monitoring {
+            if let Err(err) = monitoring::enable(py) {
+                with_profiler(|profiler| profiler.disable());
+                return Err(err);
+            }
+        } else {
+            unsafe {
+                let profiler_callback = profiler_callback as *const ();
+                let profiler_callback = mem::transmute(profiler_callback);
+                ffi::PyEval_SetProfile(profiler_callback, ffi::Py_None());
+            }
+        }
+
+        Ok(())
+    }
+}
 
 #[pymethods]
 impl AdaptiveProfiler {
     #[new]
-    fn new(resource: Option<&str>) -> Self {
-        let profiler: Box<dyn AbstractProfiler> = match resource.unwrap_or("time") {
-            "time" => {
-                let counter = crate::time::TimeCounter;
-                let profiler = Profiler::new(counter);
-                Box::new(profiler)
+    fn new(
+        resource: Option<&str>,
+        mode: Option<&str>,
+        output_path: Option<&str>,
+    ) -> PyResult<Self> {
+        let resource = resource.unwrap_or("time");
+
+        let sampler = match mode.unwrap_or("tracing") {
+            "tracing" => {
+                let mut profiler = create_profiler(resource);
+                if let Some(path) = output_path {
+                    profiler.set_output(StatsWriter::create(path)?);
+                }
+                PROFILER.with(|p| p.replace(Some(profiler)));
+                None
             }
-            "cache_misses" => {
-                let counter = crate::perfcnt::HardwarePerformanceCounter::cache_misses();
-                let profiler = Profiler::new(counter);
-                Box::new(profiler)
+            "sampling" => {
+                if resource != "time" {
+                    return Err(PyValueError::new_err(format!(
+                        "Sampling mode can only measure time, not '{}'",
+                        resource
+                    )));
+                }
+                if output_path.is_some() {
+                    return Err(PyValueError::new_err(
+                        "Sampling mode can't stream statistics to a file",
+                    ));
+                }
+                Some(Sampler::new(crate::sampling::DEFAULT_INTERVAL))
             }
-            "branch_misses" => {
-                let counter = crate::perfcnt::HardwarePerformanceCounter::branch_misses();
-                let profiler = Profiler::new(counter);
-                Box::new(profiler)
+            mode => {
+                return Err(PyValueError::new_err(format!(
+                    "Unknown profiling mode: '{}'",
+                    mode
+                )))
             }
-            resource => panic!("Unknown resource type: '{}'", resource),
         };
-        PROFILER.with(|p| p.replace(Some(profiler)));
-        Self {}
+
+        let gil = Python::acquire_gil();
+        let use_monitoring = monitoring::is_available(gil.python());
+
+        // Functions disabled by a previous profiler start with an empty blacklist here
+        if use_monitoring && sampler.is_none() {
+            monitoring::restart_events(gil.python())?;
+        }
+
+        Ok(Self {
+            use_monitoring,
+            sampler,
+            gc_was_enabled: false,
+        })
     }
 
     /// Starts the profiler for subsequent code.
-    fn enable(&self) {
-        with_profiler(|profiler| {
-            profiler.enable();
-            unsafe {
-                let profiler_callback = profiler_callback as *const ();
-                let profiler_callback = mem::transmute(profiler_callback);
-                ffi::PyEval_SetProfile(profiler_callback, ffi::Py_None());
-            }
-        });
+    ///
+    /// The garbage collector is run once and then disabled until the profiler
+    /// is disabled, so that collections don't distort the measurements.
+    fn enable(&mut self) -> PyResult<()> {
+        let gil = Python::acquire_gil();
+        let py = gil.python();
+
+        self.gc_was_enabled = gc::pause(py)?;
+
+        // `__exit__` won't be called if `__enter__` fails, so the collector has to be resumed here
+        let result = self.start(py);
+        if result.is_err() && self.gc_was_enabled {
+            gc::resume(py)?;
+        }
+
+        result
     }
 
     /// Disables the monitoring of further calls.
-    fn disable(&self) {
-        disable_profiling_hook();
+    fn disable(&mut self) -> PyResult<()> {
+        let gil = Python::acquire_gil();
+        let py = gil.python();
+
+        // The counters and the collector are restored even if unhooking fails,
+        // and the first error is returned afterwards
+        let mut result = Ok(());
+
+        if let Some(sampler) = self.sampler.as_mut() {
+            sampler.stop(py);
+        } else {
+            if self.use_monitoring {
+                result = monitoring::disable(py);
+            } else {
+                disable_profiling_hook();
+            }
+
+            with_profiler(|profiler| profiler.disable());
+        }
 
-        with_profiler(|profiler| profiler.disable());
+        if self.gc_was_enabled {
+            result = result.and(gc::resume(py));
+        }
+
+        result
     }
 
     /// Updates the list of functions to be profiled.
-    fn update(&mut self) {
-        with_profiler(|profiler| profiler.update());
+    ///
+    /// In sampling mode, adapts the sampling interval instead.
+    ///
+    /// Since the garbage collector is disabled while profiling, long-running
+    /// programs can call `gc.collect()` right after this method.
+    ///
+    /// Raises `OSError` if streaming statistics to the output file failed.
+    fn update(&mut self) -> PyResult<()> {
+        if let Some(sampler) = self.sampler.as_mut() {
+            sampler.update();
+            return Ok(());
+        }
+
+        with_profiler(|profiler| profiler.update())?;
+        Ok(())
+    }
+
+    /// Discards the statistics and blacklist gathered so far,
+    /// allowing the profiler to be reused for a different program.
+    fn reset(&mut self) -> PyResult<()> {
+        if let Some(sampler) = self.sampler.as_mut() {
+            sampler.reset();
+            return Ok(());
+        }
+
+        with_profiler(|profiler| profiler.reset());
+
+        // Functions disabled for being blacklisted have to be monitored again
+        if self.use_monitoring {
+            let gil = Python::acquire_gil();
+            monitoring::restart_events(gil.python())?;
+        }
+
+        Ok(())
+    }
+
+    /// Current time between two samples in nanoseconds, or `None` when tracing.
+    #[getter]
+    fn sampling_interval(&self) -> Option<u64> {
+        self.sampler
+            .as_ref()
+            .map(|sampler| sampler.interval().as_nanos() as u64)
     }
 
     /// Retrieves statistics for the last profiling run.
-    fn get_statistics(&mut self) -> Vec<FunctionStatistics> {
-        with_profiler(|profiler| profiler.get_statistics())
+    ///
+    /// In sampling mode, times are estimated from the samples and
+    /// `num_calls` is the number of samples the function appeared in.
+    fn get_statistics(&mut self) -> PyResult<Vec<FunctionStatistics>> {
+        if let Some(sampler) = self.sampler.as_ref() {
+            let gil = Python::acquire_gil();
+            return sampler.get_statistics(gil.python());
+        }
+
+        Ok(with_profiler(|profiler| profiler.get_statistics())?)
     }
 }
 
 #[pyproto]
 impl PyContextProtocol for AdaptiveProfiler {
-    fn __enter__(&mut self) {
-        self.enable();
+    fn __enter__(&mut self) -> PyResult<()> {
+        self.enable()
     }
 
     fn __exit__(
@@ -126,14 +310,15 @@ impl PyContextProtocol for AdaptiveProfiler {
         _exc_type: Option<&PyAny>,
         _exc_value: Option<&PyAny>,
         _traceback: Option<&PyAny>,
-    ) {
-        self.disable();
+    ) -> PyResult<()> {
+        self.disable()
     }
 }
 
 const PY_TRACE_CALL: i32 = 0;
 const PY_TRACE_RETURN: i32 = 3;
 const PY_TRACE_C_CALL: i32 = 4;
+const PY_TRACE_C_EXCEPTION: i32 = 5;
 const PY_TRACE_C_RETURN: i32 = 6;
 
 #[repr(C)]
@@ -150,27 +335,35 @@ extern "C" fn profiler_callback(
     event: i32,
     arg: *mut ffi::PyObject,
 ) -> i32 {
-    let py = unsafe { Python::assume_gil_acquired() };
-
-    if event <= PY_TRACE_RETURN {
-        let frame = unsafe { &*frame };
-        let code = unsafe { &*frame.f_code };
-        let name = unsafe { PyString::from_borrowed_ptr(py, code.co_name) };
-        let name = name.to_str().unwrap();
-
-        match event {
-            PY_TRACE_CALL => with_profiler(|profiler| profiler.on_call(name)),
-            PY_TRACE_RETURN => with_profiler(|profiler| profiler.on_return(name)),
-            _ => (),
+    match event {
+        PY_TRACE_CALL | PY_TRACE_RETURN => {
+            let frame = unsafe { &*frame };
+            let code: *mut ffi::PyObject = frame.f_code.cast();
+
+            with_profiler(|profiler| {
+                let symbol = profiler.code_symbol(code);
+                if event == PY_TRACE_CALL {
+                    profiler.on_call(symbol);
+                } else {
+                    profiler.on_return(symbol);
+                }
+            });
         }
-    } else {
-        let arg: *mut PyCFunctionObject = arg.cast();
-        let c_fn_name = unsafe { CStr::from_ptr((*(*arg).def).ml_name).to_str().unwrap() };
-        match event {
-            PY_TRACE_C_CALL => with_profiler(|p| p.on_c_call(c_fn_name)),
-            PY_TRACE_C_RETURN => with_profiler(|p| p.on_c_return(c_fn_name)),
-            _ => (),
+        PY_TRACE_C_CALL | PY_TRACE_C_EXCEPTION | PY_TRACE_C_RETURN => {
+            let arg: *mut PyCFunctionObject = arg.cast();
+            let def = unsafe { (*arg).def };
+
+            with_profiler(|profiler| {
+                let symbol = profiler.c_function_symbol(def);
+                if event == PY_TRACE_C_CALL {
+                    profiler.on_c_call(symbol);
+                } else {
+                    // A C function which raised an exception has still returned
+                    profiler.on_c_return(symbol);
+                }
+            });
         }
+        _ => (),
     }
 
     0
@@ -0,0 +1,278 @@
+//! Profiling hook based on the `sys.monitoring` API introduced by PEP 669.
+//!
+//! Unlike `PyEval_SetProfile`, this only reports the events we subscribe to,
+//! so calls into C functions no longer invoke the profiler at all.
+
+use std::{cell::Cell, mem, os::raw::c_char, ptr};
+
+use pyo3::{ffi, prelude::*, AsPyPointer};
+
+use crate::{profiler::AbstractProfiler, try_with_profiler};
+
+/// Identifier reserved by `sys.monitoring` for profilers.
+const TOOL_ID: u8 = 2;
+const TOOL_NAME: &str = "adaprof";
+
+/// Events signaling that a Python function has started or resumed executing.
+const START_EVENTS: &[&str] = &["PY_START", "PY_RESUME"];
+
+/// Events signaling that a generator or coroutine was resumed by `throw()`.
+///
+/// Unlike the other start events, these can't be disabled for individual code objects.
+const THROW_EVENTS: &[&str] = &["PY_THROW"];
+
+/// Events signaling that a Python function has returned or yielded.
+const RETURN_EVENTS: &[&str] = &["PY_RETURN", "PY_YIELD"];
+
+/// Events signaling that a Python function was exited by an exception.
+///
+/// Unlike the others, these can't be disabled for individual code objects.
+const UNWIND_EVENTS: &[&str] = &["PY_UNWIND"];
+
+type FastCallback = unsafe extern "C" fn(
+    *mut ffi::PyObject,
+    *const *mut ffi::PyObject,
+    ffi::Py_ssize_t,
+) -> *mut ffi::PyObject;
+
+/// Method definition which can be shared between threads.
+///
+/// The interpreter only ever reads the definitions it's given.
+struct MethodDef(ffi::PyMethodDef);
+
+unsafe impl Sync for MethodDef {}
+
+impl MethodDef {
+    /// Defines a function with the given name, using the fast calling convention.
+    const fn new(name: &'static [u8], callback: FastCallback) -> Self {
+        Self(ffi::PyMethodDef {
+            ml_name: name.as_ptr() as *const c_char,
+            ml_meth: unsafe { mem::transmute(callback) },
+            ml_flags: ffi::METH_FASTCALL,
+            ml_doc: ptr::null(),
+        })
+    }
+}
+
+// The method definitions have to outlive the function objects created from them.
+static START_DEF: MethodDef = MethodDef::new(b"on_start\0", on_start);
+static THROW_DEF: MethodDef = MethodDef::new(b"on_throw\0", on_throw);
+static RETURN_DEF: MethodDef = MethodDef::new(b"on_return\0", on_return);
+static UNWIND_DEF: MethodDef = MethodDef::new(b"on_unwind\0", on_unwind);
+
+thread_local! {
+    /// Whether events are being received for the current thread's profiler.
+    static IS_PROFILED_THREAD: Cell<bool> = Cell::new(false);
+}
+
+/// Calls `f` with the profiler of the current thread, if it enabled monitoring.
+///
+/// Unlike `PyEval_SetProfile`, `sys.monitoring` reports events from every thread.
+fn with_thread_profiler<F, R>(f: F) -> Option<R>
+where
+    F: FnOnce(&mut dyn AbstractProfiler) -> R,
+{
+    if !IS_PROFILED_THREAD.with(Cell::get) {
+        return None;
+    }
+    try_with_profiler(f)
+}
+
+/// Checks whether the running interpreter supports `sys.monitoring`.
+pub fn is_available(py: Python) -> bool {
+    py.import("sys")
+        .and_then(|sys| sys.hasattr("monitoring"))
+        .unwrap_or(false)
+}
+
+/// Claims the profiler tool identifier and starts receiving events.
+pub fn enable(py: Python) -> PyResult<()> {
+    let monitoring = py.import("sys")?.getattr("monitoring")?;
+
+    monitoring.call_method1("use_tool_id", (TOOL_ID, TOOL_NAME))?;
+
+    if let Err(err) = subscribe(py, monitoring) {
+        // Otherwise the identifier would stay claimed and every later attempt would fail.
+        // The original error is more useful than any raised while cleaning up.
+        let _ = disable(py);
+        return Err(err);
+    }
+
+    IS_PROFILED_THREAD.with(|flag| flag.set(true));
+
+    Ok(())
+}
+
+/// Registers the callbacks and subscribes to their events.
+fn subscribe(py: Python, monitoring: &PyAny) -> PyResult<()> {
+    let events = monitoring.getattr("events")?;
+
+    // Callbacks receive the `DISABLE` sentinel as their `self` argument
+    let disable = monitoring.getattr("DISABLE")?;
+    let start_callback = new_callback(py, &START_DEF, disable)?;
+    let throw_callback = new_callback(py, &THROW_DEF, disable)?;
+    let return_callback = new_callback(py, &RETURN_DEF, disable)?;
+    let unwind_callback = new_callback(py, &UNWIND_DEF, disable)?;
+
+    let mut event_set = 0u32;
+    for (names, callback) in &[
+        (START_EVENTS, start_callback),
+        (THROW_EVENTS, throw_callback),
+        (RETURN_EVENTS, return_callback),
+        (UNWIND_EVENTS, unwind_callback),
+    ] {
+        for name in names.iter() {
+            let event: u32 = events.getattr(*name)?.extract()?;
+            let callback = callback.clone_ref(py);
+            monitoring.call_method1("register_callback", (TOOL_ID, event, callback))?;
+            event_set |= event;
+        }
+    }
+
+    monitoring.call_method1("set_events", (TOOL_ID, event_set))?;
+
+    Ok(())
+}
+
+/// Re-enables the events disabled for blacklisted functions.
+///
+/// This affects the events disabled by every tool, so it should only be used
+/// once the blacklist has been cleared.
+pub fn restart_events(py: Python) -> PyResult<()> {
+    let monitoring = py.import("sys")?.getattr("monitoring")?;
+    monitoring.getattr("restart_events")?.call0()?;
+
+    Ok(())
+}
+
+/// Stops receiving events and releases the profiler tool identifier.
+///
+/// Every step is attempted even if an earlier one fails, so that the identifier
+/// isn't left claimed. Returns the first error.
+pub fn disable(py: Python) -> PyResult<()> {
+    let monitoring = py.import("sys")?.getattr("monitoring")?;
+    let events = monitoring.getattr("events")?;
+
+    IS_PROFILED_THREAD.with(|flag| flag.set(false));
+
+    let mut result = monitoring
+        .call_method1("set_events", (TOOL_ID, 0))
+        .map(drop);
+
+    let all_events = START_EVENTS
+        .iter()
+        .chain(THROW_EVENTS)
+        .chain(RETURN_EVENTS)
+        .chain(UNWIND_EVENTS);
+    for name in all_events {
+        let unregistered = events
+            .getattr(*name)
+            .and_then(|event| event.extract::<u32>())
+            .and_then(|event| {
+                let args = (TOOL_ID, event, py.None());
+                monitoring.call_method1("register_callback", args).map(drop)
+            });
+        result = result.and(unregistered);
+    }
+
+    let freed = monitoring
+        .call_method1("free_tool_id", (TOOL_ID,))
+        .map(drop);
+    result.and(freed)
+}
+
+/// Creates a Python callable from a method definition, bound to the given object.
+fn new_callback(py: Python, def: &'static MethodDef, slf: &PyAny) -> PyResult<PyObject> {
+    unsafe {
+        let def = &def.0 as *const ffi::PyMethodDef as *mut ffi::PyMethodDef;
+        let function = ffi::PyCFunction_NewEx(def, slf.as_ptr(), ptr::null_mut());
+        if function.is_null() {
+            return Err(PyErr::fetch(py));
+        }
+        Ok(PyObject::from_owned_ptr(py, function))
+    }
+}
+
+fn new_ref(object: *mut ffi::PyObject) -> *mut ffi::PyObject {
+    unsafe {
+        ffi::Py_INCREF(object);
+    }
+    object
+}
+
+/// Called with `(code, instruction_offset)` when a function starts or resumes.
+///
+/// Returns `DISABLE` for blacklisted functions, which stops further events
+/// from being generated for their code objects.
+unsafe extern "C" fn on_start(
+    disable: *mut ffi::PyObject,
+    args: *const *mut ffi::PyObject,
+    _nargs: ffi::Py_ssize_t,
+) -> *mut ffi::PyObject {
+    let is_blacklisted = with_thread_profiler(|profiler| {
+        let symbol = profiler.code_symbol(*args);
+        if profiler.is_blacklisted(symbol) {
+            return true;
+        }
+        profiler.on_call(symbol);
+        false
+    })
+    .unwrap_or(false);
+
+    if is_blacklisted {
+        new_ref(disable)
+    } else {
+        new_ref(ffi::Py_None())
+    }
+}
+
+/// Called with `(code, instruction_offset, exception)` when a generator or
+/// coroutine is resumed by having an exception thrown into it.
+unsafe extern "C" fn on_throw(
+    _slf: *mut ffi::PyObject,
+    args: *const *mut ffi::PyObject,
+    _nargs: ffi::Py_ssize_t,
+) -> *mut ffi::PyObject {
+    with_thread_profiler(|profiler| {
+        let symbol = profiler.code_symbol(*args);
+        profiler.on_call(symbol)
+    });
+    new_ref(ffi::Py_None())
+}
+
+/// Called with `(code, instruction_offset, value)` when a function returns or yields.
+unsafe extern "C" fn on_return(
+    disable: *mut ffi::PyObject,
+    args: *const *mut ffi::PyObject,
+    _nargs: ffi::Py_ssize_t,
+) -> *mut ffi::PyObject {
+    let is_blacklisted = with_thread_profiler(|profiler| {
+        let symbol = profiler.code_symbol(*args);
+        if profiler.is_blacklisted(symbol) {
+            return true;
+        }
+        profiler.on_return(symbol);
+        false
+    })
+    .unwrap_or(false);
+
+    if is_blacklisted {
+        new_ref(disable)
+    } else {
+        new_ref(ffi::Py_None())
+    }
+}
+
+/// Called with `(code, instruction_offset, exception)` when a function
+/// is exited by an exception.
+unsafe extern "C" fn on_unwind(
+    _slf: *mut ffi::PyObject,
+    args: *const *mut ffi::PyObject,
+    _nargs: ffi::Py_ssize_t,
+) -> *mut ffi::PyObject {
+    with_thread_profiler(|profiler| {
+        let symbol = profiler.code_symbol(*args);
+        profiler.on_return(symbol)
+    });
+    new_ref(ffi::Py_None())
+}
@@ -0,0 +1,80 @@
+//! Streams raw profiling data to a binary file, to be aggregated offline.
+//!
+//! The file starts with the `ADAPROF1` magic bytes, followed by records
+//! starting with a one byte tag. All integers are little-endian.
+//!
+//! - Name records (tag 0): `u32` symbol, `u32` length, followed by the UTF-8 name.
+//! - Call records (tag 1): `u32` symbol, `u64` total, `u64` cumulative.
+//!
+//! A symbol's name record always precedes its first call record.
+
+use std::{
+    fs::File,
+    io::{self, BufWriter, Write},
+};
+
+use string_interner::Symbol as _;
+
+use crate::profiler::{StringInterner, Symbol};
+
+const MAGIC: &[u8] = b"ADAPROF1";
+const NAME_RECORD: u8 = 0;
+const CALL_RECORD: u8 = 1;
+
+pub struct StatsWriter {
+    file: BufWriter<File>,
+    /// Number of interned names already written to the file.
+    names_written: usize,
+}
+
+impl StatsWriter {
+    /// Creates the file at the given path, replacing any existing one.
+    pub fn create(path: &str) -> io::Result<Self> {
+        let mut file = BufWriter::new(File::create(path)?);
+        file.write_all(MAGIC)?;
+
+        Ok(Self {
+            file,
+            names_written: 0,
+        })
+    }
+
+    /// Writes the statistics of the given `(symbol, total, cumulative)` calls,
+    /// preceded by the names interned since the last write.
+    pub fn write_calls<I>(&mut self, interner: &StringInterner, calls: I) -> io::Result<()>
+    where
+        I: IntoIterator<Item = (Symbol, u128, u128)>,
+    {
+        self.write_names(interner)?;
+
+        for (symbol, total, cumulative) in calls {
+            self.file.write_all(&[CALL_RECORD])?;
+            self.file
+                .write_all(&(symbol.to_usize() as u32).to_le_bytes())?;
+            self.file.write_all(&(total as u64).to_le_bytes())?;
+            self.file.write_all(&(cumulative as u64).to_le_bytes())?;
+        }
+
+        Ok(())
+    }
+
+    fn write_names(&mut self, interner: &StringInterner) -> io::Result<()> {
+        for index in self.names_written..interner.len() {
+            let symbol = Symbol::try_from_usize(index).unwrap();
+            let name = interner.resolve(symbol).unwrap();
+
+            self.file.write_all(&[NAME_RECORD])?;
+            self.file.write_all(&(index as u32).to_le_bytes())?;
+            self.file.write_all(&(name.len() as u32).to_le_bytes())?;
+            self.file.write_all(name.as_bytes())?;
+        }
+        self.names_written = interner.len();
+
+        Ok(())
+    }
+
+    /// Hands the buffered records over to the operating system.
+    pub fn flush(&mut self) -> io::Result<()> {
+        self.file.flush()
+    }
+}
@@ -1,8 +1,10 @@
 use std::{
     fs::File,
     io::{self, BufWriter, Write},
+    iter,
 };
 
+use pyo3::ffi;
 use splay::{SplayMap, SplaySet};
 
 pub(crate) type Symbol = string_interner::symbol::SymbolU32;
@@ -14,28 +16,52 @@ pub(crate) type SamplesMap<C> = SplayMap<Symbol, Vec<Statistics<C>>>;
 use crate::{
     counter::{Counter, IntoU128, Zero},
     lifecycle::Lifecycle,
+    output::StatsWriter,
     stopwatch::{Statistics, Stopwatch},
+    symbols::SymbolCache,
     update::{create_algorithm, Algorithm, UpdateAlgorithm},
     FunctionStatistics,
 };
 
+/// Number of calls buffered before their statistics are moved into the samples map.
+const PENDING_CAPACITY: usize = 4096;
+
 pub trait AbstractProfiler: Lifecycle {
     /// Updates the function blacklist based on collected data.
-    fn update(&mut self);
+    ///
+    /// Returns the first error encountered while streaming statistics since the last call.
+    fn update(&mut self) -> io::Result<()>;
+
+    /// Returns the symbol of the Python function with the given code object.
+    fn code_symbol(&mut self, code: *mut ffi::PyObject) -> Symbol;
+
+    /// Returns the symbol of the C function with the given method definition.
+    fn c_function_symbol(&mut self, def: *mut ffi::PyMethodDef) -> Symbol;
+
+    /// Checks whether the given function is no longer being profiled.
+    fn is_blacklisted(&mut self, symbol: Symbol) -> bool;
+
+    /// Discards all gathered data, including the blacklist.
+    ///
+    /// Buffered calls are still written to the output, if one was set.
+    fn reset(&mut self);
+
+    /// Streams the statistics of every recorded call to the given writer.
+    fn set_output(&mut self, output: StatsWriter);
 
     /// Called when a function is entered.
-    fn on_call(&mut self, name: &str);
+    fn on_call(&mut self, symbol: Symbol);
 
     /// Called when a function returns.
-    fn on_return(&mut self, name: &str);
+    fn on_return(&mut self, symbol: Symbol);
 
     /// Called when a C function is entered.
-    fn on_c_call(&mut self, name: &str);
+    fn on_c_call(&mut self, symbol: Symbol);
 
     /// Called when control is gained back from C code.
-    fn on_c_return(&mut self, name: &str);
+    fn on_c_return(&mut self, symbol: Symbol);
 
-    fn get_statistics(&mut self) -> Vec<FunctionStatistics>;
+    fn get_statistics(&mut self) -> io::Result<Vec<FunctionStatistics>>;
 }
 
 /// Current profiler state.
@@ -45,11 +71,17 @@ pub struct Profiler<C: Counter + Lifecycle> {
     counter: C,
     update_algorithm: Box<dyn UpdateAlgorithm<C>>,
     interner: StringInterner,
+    symbols: SymbolCache,
     blacklist: Blacklist,
     stack: Vec<Stopwatch<C>>,
+    /// Statistics of recent calls, not yet moved into `samples`.
+    pending: Vec<(Symbol, Statistics<C>)>,
     samples: SamplesMap<C>,
     previous_samples: SamplesMap<C>,
     c_enter_count: Option<C::ValueType>,
+    output: Option<StatsWriter>,
+    /// First error encountered while streaming, after which the output is closed.
+    output_error: Option<io::Error>,
 }
 
 impl<C: Counter + Lifecycle> Profiler<C> {
@@ -59,11 +91,15 @@ impl<C: Counter + Lifecycle> Profiler<C> {
             counter,
             update_algorithm: create_algorithm(Algorithm::Racing),
             interner: StringInterner::new(),
+            symbols: SymbolCache::default(),
             blacklist: SplaySet::new(),
             stack: Vec::with_capacity(1024),
+            pending: Vec::with_capacity(PENDING_CAPACITY),
             samples: SplayMap::new(),
             previous_samples: SplayMap::new(),
             c_enter_count: None,
+            output: None,
+            output_error: None,
         }
     }
 
@@ -80,11 +116,58 @@ impl<C: Counter + Lifecycle> Profiler<C> {
     }
 
     fn record_statistics(&mut self, symbol: Symbol, stats: Statistics<C>) {
-        if !self.samples.contains_key(&symbol) {
-            self.samples.insert(symbol, Vec::new());
+        if self.pending.len() == PENDING_CAPACITY {
+            self.flush_pending();
         }
 
-        self.samples.get_mut(&symbol).unwrap().push(stats);
+        // Appending to a buffer is much cheaper than looking up the symbol in the samples map
+        self.pending.push((symbol, stats));
+    }
+
+    /// Writes the statistics of buffered calls to the output, if one was set.
+    fn stream_pending(&mut self) {
+        let calls = self.pending.iter().map(|(symbol, stats)| {
+            let total = stats.total.into_u128();
+            let cumulative = stats.cumulative.into_u128();
+            (*symbol, total, cumulative)
+        });
+
+        let result = match self.output.as_mut() {
+            Some(output) => output.write_calls(&self.interner, calls),
+            None => return,
+        };
+        self.check_output(result);
+    }
+
+    /// Closes the output after the first failed write, keeping the error to be reported later.
+    ///
+    /// Writes happen inside the profiling hooks, which can't raise exceptions.
+    fn check_output(&mut self, result: io::Result<()>) {
+        if let Err(err) = result {
+            self.output = None;
+            self.output_error.get_or_insert(err);
+        }
+    }
+
+    /// Returns the error which closed the output, if any, and clears it.
+    fn take_output_error(&mut self) -> io::Result<()> {
+        match self.output_error.take() {
+            Some(err) => Err(err),
+            None => Ok(()),
+        }
+    }
+
+    /// Moves the statistics of buffered calls into the samples map.
+    fn flush_pending(&mut self) {
+        self.stream_pending();
+
+        for (symbol, stats) in self.pending.drain(..) {
+            if let Some(samples) = self.samples.get_mut(&symbol) {
+                samples.push(stats);
+            } else {
+                self.samples.insert(symbol, vec![stats]);
+            }
+        }
     }
 
     #[allow(dead_code)]
@@ -122,9 +205,36 @@ impl<C: Counter + Lifecycle> Lifecycle for Profiler<C> {
 }
 
 impl<C: Counter + Lifecycle> AbstractProfiler for Profiler<C> {
-    fn on_call(&mut self, name: &str) {
-        let symbol = self.interner.get_or_intern(name);
+    fn code_symbol(&mut self, code: *mut ffi::PyObject) -> Symbol {
+        self.symbols.code_symbol(&mut self.interner, code)
+    }
 
+    fn c_function_symbol(&mut self, def: *mut ffi::PyMethodDef) -> Symbol {
+        self.symbols.c_function_symbol(&mut self.interner, def)
+    }
+
+    fn is_blacklisted(&mut self, symbol: Symbol) -> bool {
+        self.blacklist.contains(&symbol)
+    }
+
+    fn reset(&mut self) {
+        // Interned names and cached symbols stay valid, and the buffers keep their capacity
+        self.stream_pending();
+
+        self.update_algorithm = create_algorithm(Algorithm::Racing);
+        self.blacklist = SplaySet::new();
+        self.stack.clear();
+        self.pending.clear();
+        self.samples = SplayMap::new();
+        self.previous_samples = SplayMap::new();
+        self.c_enter_count = None;
+    }
+
+    fn set_output(&mut self, output: StatsWriter) {
+        self.output = Some(output);
+    }
+
+    fn on_call(&mut self, symbol: Symbol) {
         if self.blacklist.contains(&symbol) {
             return;
         }
@@ -140,9 +250,7 @@ impl<C: Counter + Lifecycle> AbstractProfiler for Profiler<C> {
         self.stack.push(Stopwatch::new(value));
     }
 
-    fn on_return(&mut self, name: &str) {
-        let symbol = self.interner.get_or_intern(name);
-
+    fn on_return(&mut self, symbol: Symbol) {
         if self.blacklist.contains(&symbol) {
             return;
         }
@@ -164,9 +272,7 @@ impl<C: Counter + Lifecycle> AbstractProfiler for Profiler<C> {
         }
     }
 
-    fn on_c_call(&mut self, name: &str) {
-        let symbol = self.interner.get_or_intern(name);
-
+    fn on_c_call(&mut self, symbol: Symbol) {
         if self.blacklist.contains(&symbol) {
             return;
         }
@@ -174,9 +280,7 @@ impl<C: Counter + Lifecycle> AbstractProfiler for Profiler<C> {
         self.c_enter_count = Some(self.counter.read());
     }
 
-    fn on_c_return(&mut self, name: &str) {
-        let symbol = self.interner.get_or_intern(name);
-
+    fn on_c_return(&mut self, symbol: Symbol) {
         if self.blacklist.contains(&symbol) {
             return;
         }
@@ -189,28 +293,47 @@ impl<C: Counter + Lifecycle> AbstractProfiler for Profiler<C> {
         };
         self.previous_samples.insert(symbol, vec![stats]);
 
+        let call = iter::once((symbol, 0, cumulative.into_u128()));
+        if let Some(output) = self.output.as_mut() {
+            let result = output.write_calls(&self.interner, call);
+            self.check_output(result);
+        }
+
         self.c_enter_count = None;
 
         // C functions blacklisted the first time they're measured
         self.add_to_blacklist(symbol);
     }
 
-    fn update(&mut self) {
+    fn update(&mut self) -> io::Result<()> {
+        self.flush_pending();
+
+        if let Some(output) = self.output.as_mut() {
+            let result = output.flush();
+            self.check_output(result);
+        }
+
         let newly_blacklisted = self.update_algorithm.update(&self.interner, &self.samples);
 
         for symbol in newly_blacklisted {
             self.add_to_blacklist(symbol);
         }
+
+        self.take_output_error()
     }
 
     /// Returns a vector of the profiling statistics gathered so far.
-    fn get_statistics(&mut self) -> Vec<FunctionStatistics> {
+    fn get_statistics(&mut self) -> io::Result<Vec<FunctionStatistics>> {
+        self.flush_pending();
+        self.take_output_error()?;
+
         // Move all values to the previous samples map.
         for (key, _) in self.samples.clone().into_iter() {
             self.add_to_blacklist(key);
         }
 
-        self.previous_samples
+        let statistics = self
+            .previous_samples
             .clone()
             .into_iter()
             .map(|(sym, times)| {
@@ -225,6 +348,8 @@ impl<C: Counter + Lifecycle> AbstractProfiler for Profiler<C> {
                     cumulative,
                 }
             })
-            .collect()
+            .collect();
+
+        Ok(statistics)
     }
 }
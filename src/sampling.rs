@@ -0,0 +1,313 @@
+//! Statistical profiler which periodically samples the call stack of the profiled thread.
+//!
+//! The overhead of sampling depends only on the sampling rate, not on how often
+//! the profiled program calls functions.
+
+use std::{
+    collections::{HashMap, HashSet},
+    sync::{
+        atomic::{AtomicU64, Ordering},
+        Arc, Condvar, Mutex,
+    },
+    thread::{self, JoinHandle},
+    time::{Duration, Instant},
+};
+
+use pyo3::{prelude::*, types::PyDict, AsPyPointer};
+
+use crate::FunctionStatistics;
+
+/// Default time between two consecutive samples.
+pub const DEFAULT_INTERVAL: Duration = Duration::from_millis(1);
+
+/// Bounds within which the sampling interval is adapted.
+const MIN_INTERVAL: Duration = Duration::from_micros(100);
+const MAX_INTERVAL: Duration = Duration::from_millis(100);
+
+/// Fraction of the profiled program's running time the sampler aims to use.
+const TARGET_OVERHEAD: f64 = 0.05;
+
+/// Number of samples a window has to contain before the overhead measured over it is trusted.
+const MIN_WINDOW_SAMPLES: u64 = 16;
+
+/// Uniquely identifies a Python function by the address of its code object.
+type FunctionKey = usize;
+
+/// Code flags of functions whose frames can be suspended and resumed by a different caller:
+/// `CO_GENERATOR`, `CO_COROUTINE` and `CO_ASYNC_GENERATOR`.
+const CO_RESUMABLE: u32 = 0x20 | 0x80 | 0x200;
+
+struct FunctionSamples {
+    /// Strong reference to the function's code object, used to resolve its name.
+    code: PyObject,
+    /// Number of samples in which the function was on the stack.
+    samples: usize,
+    /// Time attributed to the function while it was executing.
+    total: u128,
+    /// Time attributed to the function while it was on the stack.
+    cumulative: u128,
+}
+
+pub struct Sampler {
+    /// Time between two consecutive samples, in nanoseconds.
+    interval: Arc<AtomicU64>,
+    /// Time spent holding the GIL while sampling since `window_start`, in nanoseconds.
+    busy: Arc<AtomicU64>,
+    /// Number of samples taken since `window_start`.
+    window_samples: Arc<AtomicU64>,
+    window_start: Instant,
+    samples: Arc<Mutex<HashMap<FunctionKey, FunctionSamples>>>,
+    stop: Arc<StopSignal>,
+    thread: Option<JoinHandle<()>>,
+}
+
+impl Sampler {
+    pub fn new(interval: Duration) -> Self {
+        Self {
+            interval: Arc::new(AtomicU64::new(interval.as_nanos() as u64)),
+            busy: Arc::new(AtomicU64::new(0)),
+            window_samples: Arc::new(AtomicU64::new(0)),
+            window_start: Instant::now(),
+            samples: Arc::new(Mutex::new(HashMap::new())),
+            stop: Arc::new(StopSignal::default()),
+            thread: None,
+        }
+    }
+
+    /// Returns the current time between two consecutive samples.
+    pub fn interval(&self) -> Duration {
+        Duration::from_nanos(self.interval.load(Ordering::Relaxed))
+    }
+
+    /// Adapts the sampling interval to keep the overhead measured since
+    /// the last adjustment close to the target.
+    ///
+    /// While sampling, the sampler holds the GIL and thus blocks the profiled
+    /// thread, so the overhead is the fraction of time spent sampling.
+    ///
+    /// Updates can be much more frequent than samples, so the measurements
+    /// are accumulated until the window contains enough samples to be
+    /// representative, and each adjustment only moves halfway to the target.
+    pub fn update(&mut self) {
+        if self.window_samples.load(Ordering::Relaxed) < MIN_WINDOW_SAMPLES {
+            return;
+        }
+
+        let now = Instant::now();
+        let elapsed = (now - self.window_start).as_nanos() as f64;
+        let busy = self.busy.swap(0, Ordering::Relaxed) as f64;
+        self.window_samples.store(0, Ordering::Relaxed);
+        self.window_start = now;
+
+        let current = self.interval().as_nanos() as f64;
+        let overhead = busy / elapsed;
+        let target = current * overhead / TARGET_OVERHEAD;
+        let interval = ((current + target) / 2.0)
+            .max(MIN_INTERVAL.as_nanos() as f64)
+            .min(MAX_INTERVAL.as_nanos() as f64);
+
+        self.interval.store(interval as u64, Ordering::Relaxed);
+    }
+
+    /// Starts sampling the stack of the calling thread from a background thread.
+    pub fn start(&mut self, py: Python) -> PyResult<()> {
+        let thread_id: u64 = py
+            .import("threading")?
+            .getattr("get_ident")?
+            .call0()?
+            .extract()?;
+
+        let interval = Arc::clone(&self.interval);
+        let busy = Arc::clone(&self.busy);
+        let window_samples = Arc::clone(&self.window_samples);
+        let samples = Arc::clone(&self.samples);
+        let stop = Arc::clone(&self.stop);
+        stop.set(false);
+
+        busy.store(0, Ordering::Relaxed);
+        window_samples.store(0, Ordering::Relaxed);
+        self.window_start = Instant::now();
+
+        self.thread = Some(thread::spawn(move || {
+            let mut last_sample = Instant::now();
+            let mut cache = StackCache::default();
+            loop {
+                if stop.wait(Duration::from_nanos(interval.load(Ordering::Relaxed))) {
+                    break;
+                }
+
+                Python::with_gil(|py| {
+                    // Attribute the time elapsed since the previous sample
+                    let now = Instant::now();
+                    let elapsed = (now - last_sample).as_nanos();
+                    last_sample = now;
+
+                    if let Err(err) = sample(py, thread_id, elapsed, &samples, &mut cache) {
+                        err.print(py);
+                    }
+
+                    let sampling_time = now.elapsed().as_nanos() as u64;
+                    busy.fetch_add(sampling_time, Ordering::Relaxed);
+                    window_samples.fetch_add(1, Ordering::Relaxed);
+                });
+            }
+        }));
+
+        Ok(())
+    }
+
+    /// Stops the sampling thread and waits for it to exit.
+    pub fn stop(&mut self, py: Python) {
+        self.stop.set(true);
+
+        if let Some(thread) = self.thread.take() {
+            // The sampling thread might be waiting to acquire the GIL
+            py.allow_threads(|| thread.join())
+                .expect("Sampling thread panicked");
+        }
+    }
+
+    /// Discards the samples gathered so far, and restarts adapting the interval from the default.
+    pub fn reset(&mut self) {
+        self.samples.lock().unwrap().clear();
+
+        let interval = DEFAULT_INTERVAL.as_nanos() as u64;
+        self.interval.store(interval, Ordering::Relaxed);
+        self.busy.store(0, Ordering::Relaxed);
+        self.window_samples.store(0, Ordering::Relaxed);
+        self.window_start = Instant::now();
+    }
+
+    /// Returns the statistics estimated from the samples gathered so far.
+    pub fn get_statistics(&self, py: Python) -> PyResult<Vec<FunctionStatistics>> {
+        let samples = self.samples.lock().unwrap();
+
+        samples
+            .values()
+            .map(|stats| {
+                let name = stats.code.as_ref(py).getattr("co_name")?.extract()?;
+                Ok(FunctionStatistics {
+                    name,
+                    num_calls: stats.samples,
+                    total: stats.total,
+                    cumulative: stats.cumulative,
+                })
+            })
+            .collect()
+    }
+}
+
+impl Drop for Sampler {
+    fn drop(&mut self) {
+        self.stop.set(true);
+    }
+}
+
+/// Flag which wakes up the sampling thread as soon as it's set.
+#[derive(Default)]
+struct StopSignal {
+    stopped: Mutex<bool>,
+    wakeup: Condvar,
+}
+
+impl StopSignal {
+    fn set(&self, stopped: bool) {
+        *self.stopped.lock().unwrap() = stopped;
+        self.wakeup.notify_all();
+    }
+
+    /// Waits for the given duration, returning early with `true` if the flag is set.
+    fn wait(&self, timeout: Duration) -> bool {
+        let stopped = self.stopped.lock().unwrap();
+        let (stopped, _) = self
+            .wakeup
+            .wait_timeout_while(stopped, timeout, |stopped| !*stopped)
+            .unwrap();
+        *stopped
+    }
+}
+
+/// Stack seen by the previous sample.
+#[derive(Default)]
+struct StackCache {
+    /// Strong reference to the top frame, so that its address can't be reused.
+    ///
+    /// Left empty if the stack can't be reused by the next sample.
+    top: Option<PyObject>,
+    /// Code objects of the distinct functions on the stack, starting with the one on top.
+    codes: Vec<PyObject>,
+}
+
+/// Samples the current stack of the given thread, attributing `elapsed` nanoseconds
+/// to the functions found on it.
+///
+/// The stack below a frame can't change while that frame is executing,
+/// so the stack is only walked again if the top frame changed.
+/// This doesn't hold for stacks containing generators or coroutines,
+/// which can be resumed by a different caller, so those are never cached.
+fn sample(
+    py: Python,
+    thread_id: u64,
+    elapsed: u128,
+    samples: &Mutex<HashMap<FunctionKey, FunctionSamples>>,
+    cache: &mut StackCache,
+) -> PyResult<()> {
+    let frames = py.import("sys")?.getattr("_current_frames")?.call0()?;
+    let frames: &PyDict = frames.downcast()?;
+
+    // The profiled thread might have already exited
+    let top = match frames.get_item(thread_id) {
+        Some(frame) => frame,
+        None => return Ok(()),
+    };
+
+    let mut samples = samples.lock().unwrap();
+
+    let is_cached = cache
+        .top
+        .as_ref()
+        .map_or(false, |cached| cached.as_ptr() == top.as_ptr());
+
+    if !is_cached {
+        cache.top = None;
+        cache.codes.clear();
+
+        // Recursive functions should only be counted once per sample
+        let mut seen = HashSet::new();
+        let mut is_resumable = false;
+
+        let mut frame = top;
+        while !frame.is_none() {
+            let code = frame.getattr("f_code")?;
+            if seen.insert(code.as_ptr() as FunctionKey) {
+                let flags: u32 = code.getattr("co_flags")?.extract()?;
+                is_resumable |= flags & CO_RESUMABLE != 0;
+                cache.codes.push(code.into());
+            }
+
+            frame = frame.getattr("f_back")?;
+        }
+
+        if !is_resumable {
+            cache.top = Some(top.into());
+        }
+    }
+
+    for (index, code) in cache.codes.iter().enumerate() {
+        let key = code.as_ptr() as FunctionKey;
+        let stats = samples.entry(key).or_insert_with(|| FunctionSamples {
+            code: code.clone_ref(py),
+            samples: 0,
+            total: 0,
+            cumulative: 0,
+        });
+
+        if index == 0 {
+            stats.total += elapsed;
+        }
+        stats.samples += 1;
+        stats.cumulative += elapsed;
+    }
+
+    Ok(())
+}
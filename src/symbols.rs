@@ -0,0 +1,82 @@
+//! Maps Python code objects and C functions to the symbols of their interned names.
+//!
+//! Lookups are keyed by address, so the names only have to be read and hashed
+//! the first time a function is seen.
+
+use std::{collections::HashMap, ffi::CStr, os::raw::c_char, slice, str};
+
+use pyo3::{ffi, prelude::*};
+
+use crate::profiler::{StringInterner, Symbol};
+
+#[derive(Default)]
+pub struct SymbolCache {
+    code: HashMap<usize, Symbol>,
+    /// Strong references to the cached code objects, preventing their addresses from being reused.
+    code_objects: Vec<PyObject>,
+    c_functions: HashMap<usize, Symbol>,
+}
+
+impl SymbolCache {
+    /// Returns the symbol for the function with the given code object.
+    pub fn code_symbol(
+        &mut self,
+        interner: &mut StringInterner,
+        code: *mut ffi::PyObject,
+    ) -> Symbol {
+        let key = code as usize;
+        if let Some(&symbol) = self.code.get(&key) {
+            return symbol;
+        }
+
+        let symbol = unsafe { with_code_name(code, |name| interner.get_or_intern(name)) };
+
+        let py = unsafe { Python::assume_gil_acquired() };
+        self.code_objects
+            .push(unsafe { PyObject::from_borrowed_ptr(py, code) });
+        self.code.insert(key, symbol);
+
+        symbol
+    }
+
+    /// Returns the symbol for the C function with the given method definition.
+    pub fn c_function_symbol(
+        &mut self,
+        interner: &mut StringInterner,
+        def: *mut ffi::PyMethodDef,
+    ) -> Symbol {
+        let key = def as usize;
+        if let Some(&symbol) = self.c_functions.get(&key) {
+            return symbol;
+        }
+
+        let name = unsafe { CStr::from_ptr((*def).ml_name).to_str().unwrap() };
+        let symbol = interner.get_or_intern(name);
+        self.c_functions.insert(key, symbol);
+
+        symbol
+    }
+}
+
+/// Calls `f` with the name of the given code object.
+unsafe fn with_code_name<F, R>(code: *mut ffi::PyObject, f: F) -> R
+where
+    F: FnOnce(&str) -> R,
+{
+    let name = ffi::PyObject_GetAttrString(code, b"co_name\0".as_ptr() as *const c_char);
+    if name.is_null() {
+        panic!("Failed to get the name of a code object");
+    }
+
+    let mut size = 0;
+    let data = ffi::PyUnicode_AsUTF8AndSize(name, &mut size);
+    if data.is_null() {
+        panic!("Failed to encode the name of a code object as UTF-8");
+    }
+    let bytes = slice::from_raw_parts(data as *const u8, size as usize);
+    let result = f(str::from_utf8_unchecked(bytes));
+
+    ffi::Py_DECREF(name);
+
+    result
+}
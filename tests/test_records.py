@@ -0,0 +1,57 @@
+import os
+import struct
+import tempfile
+import unittest
+
+from util.records import read_records
+
+
+def name_record(symbol: int, name: str) -> bytes:
+    encoded = name.encode('utf-8')
+    return bytes([0]) + struct.pack('<II', symbol, len(encoded)) + encoded
+
+
+def call_record(symbol: int, total: int, cumulative: int) -> bytes:
+    return bytes([1]) + struct.pack('<IQQ', symbol, total, cumulative)
+
+
+class ReadRecordsTest(unittest.TestCase):
+    "Checks the reader against the file format written by `src/output.rs`."
+
+    def read(self, data: bytes):
+        with tempfile.NamedTemporaryFile(delete=False) as file:
+            file.write(data)
+        try:
+            return read_records(file.name)
+        finally:
+            os.remove(file.name)
+
+    def test_aggregates_calls_per_function(self):
+        stats = self.read(
+            b'ADAPROF1'
+            + name_record(0, 'multiply')
+            + call_record(0, 5, 7)
+            + name_record(1, 'main')
+            + call_record(1, 10, 30)
+            + call_record(0, 1, 2))
+
+        rows = {row.name: row for row in stats}
+        self.assertEqual(rows['multiply'], ('multiply', 2, 6, 9))
+        self.assertEqual(rows['main'], ('main', 1, 10, 30))
+
+    def test_ignores_truncated_tail(self):
+        data = b'ADAPROF1' + name_record(0, 'f') + call_record(0, 3, 4)
+        truncated = data + call_record(0, 1, 1)[:-3]
+
+        with self.assertWarns(UserWarning):
+            stats = self.read(truncated)
+
+        self.assertEqual(list(stats), [('f', 1, 3, 4)])
+
+    def test_rejects_other_files(self):
+        with self.assertRaises(ValueError):
+            self.read(b'not a profile')
+
+
+if __name__ == '__main__':
+    unittest.main()
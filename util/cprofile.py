@@ -1,129 +1,36 @@
 import cProfile
-import os
 import pstats
-import re
-import sys
-import threading
-from typing import List, NamedTuple
 
+import numpy as np
 
-class FunctionStatistics(NamedTuple):
-    name: str
-    num_calls: int
-    total: int
-    cumulative: int
+from util.stats import StatsTable
 
-    def __repr__(self) -> str:
-        return f'{self.name} ({self.num_calls} calls): {self.total} ns / {self.cumulative} ns'
 
+def parse(profile: cProfile.Profile) -> StatsTable:
+    "Extracts the statistics gathered by cProfile."
 
-class StdoutCapturer:
-    def __init__(self):
-        self.captured_stdout = ''
+    stats = pstats.Stats(profile).stats
 
-    def __enter__(self):
-        self.stdout_fileno = sys.stdout.fileno()
-        self.original_stdout = os.dup(self.stdout_fileno)
+    names = []
+    num_calls_column = []
+    total_column = []
+    cumulative_column = []
 
-        # Create a new pipe
-        self.stdout_pipe = os.pipe()
+    for (file_name, _, fn_name), fn_stats in stats.items():
+        # Primitive call count, total calls, total time, cumulative time, callers
+        num_calls, _, total_time, cumulative_time, _ = fn_stats
 
-        # Replace stdout with the pipe's input
-        os.dup2(self.stdout_pipe[1], self.stdout_fileno)
-        os.close(self.stdout_pipe[1])
+        # Remove the brackets from built-in function/method names
+        if file_name == '~' and fn_name.startswith('<'):
+            fn_name = fn_name[1:-1]
 
-        def drain_pipe():
-            while True:
-                data = os.read(self.stdout_pipe[0], 1024)
-                if not data:
-                    break
-                self.captured_stdout += data.decode()
+        names.append(fn_name)
+        num_calls_column.append(num_calls)
+        total_column.append(total_time)
+        cumulative_column.append(cumulative_time)
 
-        self.pipe_reader = threading.Thread(target=drain_pipe)
-        self.pipe_reader.start()
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        # Close the input of the pipe to make the reader thread exit
-        os.close(self.stdout_fileno)
-        self.pipe_reader.join()
-
-        # Clean up the pipe and restore the original stdout
-        os.close(self.stdout_pipe[0])
-        os.dup2(self.original_stdout, self.stdout_fileno)
-        os.close(self.original_stdout)
-
-
-def capture_stats_output(profile: cProfile.Profile) -> str:
-    "Captures the cProfile statistics output to a string."
-
-    stats = pstats.Stats(profile)
-    stats.sort_stats(pstats.SortKey.STDNAME)
-
-    capture = StdoutCapturer()
-    with capture:
-        stats.print_stats()
-
-    return capture.captured_stdout
-
-
-def parse(output: str) -> List[FunctionStatistics]:
-    "Parses the cProfile output."
-
-    lines = output.splitlines()
-    stripped = [l.strip() for l in lines]
-    non_empty = [l for l in stripped if len(l) != 0]
-
-    assert 'Ordered by: standard name' == non_empty[1]
-
-    # Check that the column names match our expected format
-    header = non_empty[2]
-    check_header(header)
-
-    special_method_name_pattern = re.compile(r'\{(.+)\}')
-    fn_name_pattern = re.compile(r'(\(.+\))')
-
-    stats = []
-
-    for line in non_empty[3:]:
-        elems = line.split()
-
-        if '/' in elems[0]:
-            num_calls = int(elems[0].split('/')[1])
-        else:
-            num_calls = int(elems[0])
-        total_time = float(elems[1])
-        total_time_per_call = float(elems[2])
-        cumulative_time = float(elems[3])
-        cumulative_time_per_call = float(elems[4])
-
-        fn_name = None
-        matches = special_method_name_pattern.search(line)
-        if matches:
-            fn_name = matches.group(0)
-        else:
-            matches = fn_name_pattern.search(elems[-1])
-            if matches:
-                fn_name = matches.group(0)
-            else:
-                raise Exception(
-                    'Could not parse function name from cProfile output')
-
-        # Remove the parantheses/brackets from the function/method name
-        fn_name = fn_name[1:-1]
-
-        total_time_ns = int(total_time * 1_000_000_000)
-        cumulative_time_ns = int(cumulative_time * 1_000_000_000)
-
-        stats.append(FunctionStatistics(
-            fn_name, num_calls, total_time_ns, cumulative_time_ns))
-
-    return stats
-
-
-def check_header(header: str):
-    "Checks the give stats header to match the supported format."
-    columns = header.split()
-
-    assert 'ncalls' == columns[0]
-    assert 'tottime' == columns[1]
-    assert 'cumtime' == columns[3]
+    return StatsTable(
+        names,
+        np.array(num_calls_column, dtype=np.int64),
+        (np.array(total_column) * 1_000_000_000).astype(np.int64),
+        (np.array(cumulative_column) * 1_000_000_000).astype(np.int64))
@@ -0,0 +1,15 @@
+import gc
+from contextlib import contextmanager
+
+
+@contextmanager
+def gc_disabled():
+    "Runs a full collection, then disables the garbage collector for the enclosed code."
+    was_enabled = gc.isenabled()
+    gc.collect()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
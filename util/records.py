@@ -0,0 +1,87 @@
+import struct
+import warnings
+from typing import Dict, List
+
+import numpy as np
+
+from util.stats import StatsTable
+
+MAGIC = b'ADAPROF1'
+NAME_RECORD = 0
+CALL_RECORD = 1
+
+_NAME_HEADER = struct.Struct('<II')
+_CALL = struct.Struct('<IQQ')
+
+
+class _TruncatedRecord(Exception):
+    pass
+
+
+def _read_record(data: bytes, offset: int, names: Dict[int, str], symbols: List[int],
+                 totals: List[int], cumulatives: List[int]) -> int:
+    "Reads the record starting at `offset` and returns the offset of the next one."
+
+    tag = data[offset]
+    offset += 1
+
+    try:
+        if tag == NAME_RECORD:
+            symbol, length = _NAME_HEADER.unpack_from(data, offset)
+            offset += _NAME_HEADER.size
+            if offset + length > len(data):
+                raise _TruncatedRecord
+            names[symbol] = data[offset:offset + length].decode('utf-8')
+            return offset + length
+
+        if tag == CALL_RECORD:
+            symbol, total, cumulative = _CALL.unpack_from(data, offset)
+            symbols.append(symbol)
+            totals.append(total)
+            cumulatives.append(cumulative)
+            return offset + _CALL.size
+    except struct.error:
+        raise _TruncatedRecord from None
+
+    raise ValueError(f'Unknown record tag {tag} at offset {offset - 1}')
+
+
+def read_records(path: str) -> StatsTable:
+    "Aggregates the call records streamed to a file by `AdaptiveProfiler`."
+
+    with open(path, 'rb') as file:
+        data = file.read()
+
+    if not data.startswith(MAGIC):
+        raise ValueError(f"'{path}' is not an adaprof output file")
+
+    names = {}
+    symbols = []
+    totals = []
+    cumulatives = []
+
+    offset = len(MAGIC)
+    while offset < len(data):
+        # The last record is cut short if the profiled program was killed mid-write
+        try:
+            offset = _read_record(data, offset, names, symbols, totals, cumulatives)
+        except _TruncatedRecord:
+            warnings.warn(f"'{path}' ends with a truncated record, which was ignored")
+            break
+
+    symbols = np.array(symbols, dtype=np.int64)
+    present = np.unique(symbols)
+
+    # Sum the calls of each function, indexed by symbol
+    size = len(names)
+    num_calls = np.bincount(symbols, minlength=size)
+    total_ns = np.zeros(size, dtype=np.int64)
+    cumulative_ns = np.zeros(size, dtype=np.int64)
+    np.add.at(total_ns, symbols, np.array(totals, dtype=np.int64))
+    np.add.at(cumulative_ns, symbols, np.array(cumulatives, dtype=np.int64))
+
+    return StatsTable(
+        [names[symbol] for symbol in present],
+        num_calls[present].astype(np.int64),
+        total_ns[present],
+        cumulative_ns[present])
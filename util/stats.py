@@ -0,0 +1,53 @@
+from dataclasses import dataclass
+from typing import Iterable, Iterator, List, NamedTuple
+
+import numpy as np
+
+
+class FunctionStatistics(NamedTuple):
+    name: str
+    num_calls: int
+    total: int
+    cumulative: int
+
+    def __repr__(self) -> str:
+        return f'{self.name} ({self.num_calls} calls): {self.total} ns / {self.cumulative} ns'
+
+
+@dataclass
+class StatsTable:
+    "Statistics of profiled functions, stored as one array per column."
+
+    names: List[str]
+    num_calls: np.ndarray
+    total_ns: np.ndarray
+    cumulative_ns: np.ndarray
+
+    @classmethod
+    def from_rows(cls, rows: Iterable) -> 'StatsTable':
+        "Builds a table from objects with the fields of `FunctionStatistics`."
+        rows = list(rows)
+        return cls(
+            [row.name for row in rows],
+            np.array([row.num_calls for row in rows], dtype=np.int64),
+            np.array([row.total for row in rows], dtype=np.int64),
+            np.array([row.cumulative for row in rows], dtype=np.int64))
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __getitem__(self, index: int) -> FunctionStatistics:
+        return FunctionStatistics(
+            self.names[index], int(self.num_calls[index]),
+            int(self.total_ns[index]), int(self.cumulative_ns[index]))
+
+    def __iter__(self) -> Iterator[FunctionStatistics]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def sorted_by_total(self) -> 'StatsTable':
+        "Returns a copy of the table, sorted by decreasing total time."
+        order = np.argsort(self.total_ns, kind='stable')[::-1]
+        return StatsTable(
+            [self.names[index] for index in order],
+            self.num_calls[order], self.total_ns[order], self.cumulative_ns[order])
@@ -1,7 +1,16 @@
-from time import time_ns
+from time import perf_counter_ns
+
+
+def elapsed_ns(fn, *args, **kwargs) -> int:
+    "Calls `fn` with the given arguments, returning how long it took in nanoseconds."
+    start_time = perf_counter_ns()
+    fn(*args, **kwargs)
+    return perf_counter_ns() - start_time
 
 
 class Timer:
+    __slots__ = ('label', 'start_time', 'end_time')
+
     def __init__(self, label: str) -> None:
         self.label = label
 
@@ -10,7 +19,7 @@ class Timer:
         return self.end_time - self.start_time
 
     def __enter__(self):
-        self.start_time = time_ns()
+        self.start_time = perf_counter_ns()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.end_time = time_ns()
+        self.end_time = perf_counter_ns()